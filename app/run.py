@@ -0,0 +1,46 @@
+import asyncio
+import os
+
+import uvicorn
+
+from app.main import create_schema, engine, get_settings
+
+
+def log_config(level: str) -> dict:
+    # Covers uvicorn's own lines from before the app's lifespan takes over logging
+    # ("Started server process", "Waiting for application startup.") in the same JSON format
+    return {
+        "version": 1,
+        "disable_existing_loggers": False,
+        "formatters": {"json": {"()": "app.main.JsonFormatter"}},
+        "handlers": {"default": {"class": "logging.StreamHandler", "formatter": "json"}},
+        "loggers": {"uvicorn": {"handlers": ["default"], "level": level.upper(), "propagate": False}},
+    }
+
+
+async def _prepare_database() -> None:
+    await create_schema()
+    # Workers open their own pools; don't hand them this process's connections
+    await engine.dispose()
+
+
+def main() -> None:
+    # Production entry point: uvloop and httptools (both from uvicorn[standard]) replace the
+    # asyncio loop and h11 parser, and one worker process per CPU by default.
+    # The schema is created here, once, so worker lifespans don't race on create_all.
+    asyncio.run(_prepare_database())
+    os.environ["DB_CREATE_SCHEMA"] = "false"
+    uvicorn.run(
+        "app.main:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        log_config=log_config(get_settings().LOG_LEVEL),
+        access_log=False,
+    )
+
+
+if __name__ == "__main__":
+    main()
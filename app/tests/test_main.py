@@ -1,27 +1,61 @@
+import asyncio
+import logging
+import os
+from logging.handlers import QueueHandler
+
+import orjson
 import pytest
 from fastapi import Depends, FastAPI, status
+from fastapi.dependencies.utils import get_dependant
 from fastapi.testclient import TestClient
+from sqlalchemy import make_url
 
-from app.main import Settings, get_settings, verify_api_key
+from app.main import (
+    CompactJsonFormatter,
+    JsonFormatter,
+    Payment,
+    PaymentBatcher,
+    PaymentCreate,
+    Settings,
+    _async_db_url,
+    _create_engine,
+    configure_logging,
+    get_settings,
+    stop_logging,
+    verify_api_key,
+)
 
 
 class TestVerifyApiKey:
+    @pytest.fixture(autouse=True)
+    def fresh_settings(self):
+        # Settings are cached process-wide; make env overrides in a test stay in that test
+        get_settings.cache_clear()
+        yield
+        get_settings.cache_clear()
+
     def test_verify_api_key_accepts_matching_key(self):
-        cfg = Settings()
+        cfg = get_settings()
         # Should not raise
-        assert verify_api_key(cfg=cfg, x_api_key=cfg.API_KEY) is None
+        assert asyncio.run(verify_api_key(x_api_key=cfg.API_KEY)) is None
 
-    def test_verify_api_key_uses_overridden_settings_value(self):
+    def test_verify_api_key_uses_overridden_settings_value(self, monkeypatch):
         custom_key = "custom-secret-key-123"
-        cfg = Settings(API_KEY=custom_key)
+        monkeypatch.setenv("API_KEY", custom_key)
+        get_settings.cache_clear()
         # Accepts the custom key
-        assert verify_api_key(cfg=cfg, x_api_key=custom_key) is None
+        assert asyncio.run(verify_api_key(x_api_key=custom_key)) is None
         # Rejects a different key
         with pytest.raises(Exception) as excinfo:
-            verify_api_key(cfg=cfg, x_api_key="some-other-key")
+            asyncio.run(verify_api_key(x_api_key="some-other-key"))
         assert getattr(excinfo.value, "status_code", None) == status.HTTP_401_UNAUTHORIZED
         assert getattr(excinfo.value, "detail", None) == "Invalid or missing API key"
 
+    def test_verify_api_key_resolves_only_the_header(self):
+        dependant = get_dependant(path="/protected", call=verify_api_key)
+        assert dependant.dependencies == []
+        assert [param.alias for param in dependant.header_params] == ["X-API-KEY"]
+
     def test_verify_api_key_reads_case_insensitive_header_alias(self):
         app = FastAPI()
 
@@ -37,29 +71,279 @@ class TestVerifyApiKey:
         assert resp.json() == {"ok": True}
 
     def test_verify_api_key_missing_header_raises_401(self):
-        cfg = Settings()
         with pytest.raises(Exception) as excinfo:
-            verify_api_key(cfg=cfg)
+            asyncio.run(verify_api_key())
         assert getattr(excinfo.value, "status_code", None) == status.HTTP_401_UNAUTHORIZED
         assert getattr(excinfo.value, "detail", None) == "Invalid or missing API key"
 
     def test_verify_api_key_incorrect_value_raises_401(self):
-        cfg = Settings()
         with pytest.raises(Exception) as excinfo:
-            verify_api_key(cfg=cfg, x_api_key="incorrect-key")
+            asyncio.run(verify_api_key(x_api_key="incorrect-key"))
         assert getattr(excinfo.value, "status_code", None) == status.HTTP_401_UNAUTHORIZED
         assert getattr(excinfo.value, "detail", None) == "Invalid or missing API key"
 
     def test_verify_api_key_blank_or_whitespace_value_raises_401(self):
-        cfg = Settings()
         # Empty string
         with pytest.raises(Exception) as excinfo_empty:
-            verify_api_key(cfg=cfg, x_api_key="")
+            asyncio.run(verify_api_key(x_api_key=""))
         assert getattr(excinfo_empty.value, "status_code", None) == status.HTTP_401_UNAUTHORIZED
         assert getattr(excinfo_empty.value, "detail", None) == "Invalid or missing API key"
 
         # Whitespace-only string
         with pytest.raises(Exception) as excinfo_ws:
-            verify_api_key(cfg=cfg, x_api_key="   ")
+            asyncio.run(verify_api_key(x_api_key="   "))
         assert getattr(excinfo_ws.value, "status_code", None) == status.HTTP_401_UNAUTHORIZED
-        assert getattr(excinfo_ws.value, "detail", None) == "Invalid or missing API key"
\ No newline at end of file
+        assert getattr(excinfo_ws.value, "detail", None) == "Invalid or missing API key"
+
+    def test_verify_api_key_non_ascii_value_raises_401(self):
+        with pytest.raises(Exception) as excinfo:
+            asyncio.run(verify_api_key(x_api_key="clé-secrète"))
+        assert getattr(excinfo.value, "status_code", None) == status.HTTP_401_UNAUTHORIZED
+        assert getattr(excinfo.value, "detail", None) == "Invalid or missing API key"
+
+
+class TestJsonFormatter:
+    def _record(self, msg, **kwargs):
+        return logging.LogRecord("app.test", logging.INFO, __file__, 1, msg, None, None, **kwargs)
+
+    def test_format_emits_single_json_line_with_core_fields(self):
+        line = JsonFormatter().format(self._record("payment_created"))
+        assert "\n" not in line
+        body = orjson.loads(line)
+        assert body["level"] == "INFO"
+        assert body["logger"] == "app.test"
+        assert body["message"] == "payment_created"
+        assert body["timestamp"].endswith("Z")
+
+    def test_format_keeps_non_ascii_and_merges_extra(self):
+        record = self._record("paiement reçu €")
+        record.extra = {"env": "test"}
+        line = JsonFormatter().format(record)
+        assert "reçu €" in line
+        assert orjson.loads(line)["env"] == "test"
+
+    def test_format_timestamp_comes_from_record_creation_time(self):
+        formatter = JsonFormatter()
+        first = self._record("first")
+        first.created, first.msecs = 1700000000.5, 500.0
+        second = self._record("second")
+        second.created, second.msecs = 1700000001.007, 7.0
+        assert orjson.loads(formatter.format(first))["timestamp"] == "2023-11-14T22:13:20.500Z"
+        # A new second must not reuse the cached prefix of the previous one
+        assert orjson.loads(formatter.format(second))["timestamp"] == "2023-11-14T22:13:21.007Z"
+
+
+class TestAsyncDbUrl:
+    @pytest.mark.parametrize(
+        ("url", "expected"),
+        [
+            ("postgresql+psycopg://u:p@db:5432/payments", "postgresql+asyncpg://u:p@db:5432/payments"),
+            ("postgresql://u:p@db:5432/payments", "postgresql+asyncpg://u:p@db:5432/payments"),
+            ("sqlite+pysqlite:///./payments.db", "sqlite+aiosqlite:///./payments.db"),
+            ("sqlite:///:memory:", "sqlite+aiosqlite:///:memory:"),
+        ],
+    )
+    def test_sync_drivers_are_swapped_for_async_ones(self, url, expected):
+        assert _async_db_url(url) == expected
+
+    def test_async_urls_are_left_untouched(self):
+        url = "postgresql+asyncpg://u:p@db:5432/payments"
+        assert _async_db_url(url) == url
+
+    def test_libpq_sslmode_becomes_asyncpg_ssl(self):
+        url = _async_db_url("postgresql+psycopg://u:p@db:5432/payments?sslmode=require")
+        assert url == "postgresql+asyncpg://u:p@db:5432/payments?ssl=require"
+        # The dialect passes it straight to asyncpg.connect(ssl=...)
+        _, connect_kwargs = _create_engine(Settings(DATABASE_URL=url)).dialect.create_connect_args(make_url(url))
+        assert connect_kwargs["ssl"] == "require"
+
+    def test_psycopg_only_parameters_are_rejected(self):
+        with pytest.raises(ValueError, match="connect_timeout"):
+            _async_db_url("postgresql://u:p@db:5432/payments?sslmode=require&connect_timeout=10")
+
+
+class TestCreateEngine:
+    def test_server_backends_get_pool_settings(self):
+        cfg = Settings(DATABASE_URL="postgresql+asyncpg://u:p@db:5432/payments", DB_POOL_SIZE=5, DB_MAX_OVERFLOW=2)
+        engine = _create_engine(cfg)
+        assert engine.pool.size() == 5
+        assert engine.pool._max_overflow == 2
+        assert engine.pool._recycle == cfg.DB_POOL_RECYCLE
+        assert engine.pool._pre_ping is False
+
+    def test_in_memory_sqlite_keeps_its_static_pool(self):
+        engine = _create_engine(Settings(DATABASE_URL="sqlite+aiosqlite:///:memory:"))
+        assert engine.dialect.name == "sqlite"
+        assert type(engine.pool).__name__ == "StaticPool"
+
+    def test_file_sqlite_gets_pool_settings(self, tmp_path):
+        cfg = Settings(DATABASE_URL=f"sqlite+aiosqlite:///{tmp_path / 'payments.db'}", DB_POOL_SIZE=3, DB_MAX_OVERFLOW=1)
+        engine = _create_engine(cfg)
+        assert engine.pool.size() == 3
+        assert engine.pool._max_overflow == 1
+
+    def test_sqlite_file_connections_use_wal(self, tmp_path):
+        engine = _create_engine(Settings(DATABASE_URL=f"sqlite+aiosqlite:///{tmp_path / 'payments.db'}"))
+
+        async def pragmas():
+            async with engine.connect() as conn:
+                journal = (await conn.exec_driver_sql("PRAGMA journal_mode")).scalar()
+                synchronous = (await conn.exec_driver_sql("PRAGMA synchronous")).scalar()
+            await engine.dispose()
+            return journal, synchronous
+
+        # synchronous=1 is NORMAL
+        assert asyncio.run(pragmas()) == ("wal", 1)
+
+
+class TestPaymentIndexes:
+    def test_only_order_id_carries_a_secondary_index(self):
+        indexed = {col.name for index in Payment.__table__.indexes for col in index.columns}
+        assert indexed == {"order_id"}
+
+
+class TestPaymentBatcher:
+    def test_failed_batch_is_reported_to_every_caller(self):
+        def broken_session_factory():
+            raise RuntimeError("database unavailable")
+
+        async def submit_two():
+            batcher = PaymentBatcher(broken_session_factory, max_wait=0.01)
+            try:
+                return await asyncio.gather(
+                    batcher.submit(PaymentCreate(order_id="ORD1", amount=1)),
+                    batcher.submit(PaymentCreate(order_id="ORD2", amount=2)),
+                    return_exceptions=True,
+                )
+            finally:
+                await batcher.stop()
+
+        results = asyncio.run(submit_two())
+        assert [str(r) for r in results] == ["database unavailable"] * 2
+
+    def test_crashed_flusher_is_restarted_and_its_batch_failed(self):
+        async def scenario():
+            batcher = PaymentBatcher(None, max_wait=0)
+            calls = []
+
+            async def flaky_flush(batch):
+                calls.append(batch)
+                if len(calls) == 1:
+                    raise RuntimeError("flusher bug")
+                for _, _, future in batch:
+                    future.set_result("stored")
+
+            batcher._flush = flaky_flush
+            first = asyncio.create_task(batcher.submit(PaymentCreate(order_id="ORD1", amount=1)))
+            try:
+                # Failed as soon as the flusher dies, without waiting for another submit
+                first_error = await asyncio.wait_for(asyncio.gather(first, return_exceptions=True), 1)
+                second = await asyncio.wait_for(batcher.submit(PaymentCreate(order_id="ORD2", amount=2)), 1)
+            finally:
+                await batcher.stop()
+            return first_error[0], second
+
+        first_error, second = asyncio.run(scenario())
+        assert str(first_error) == "flusher bug"
+        assert second == "stored"
+
+    def test_stop_fails_batch_being_written(self):
+        async def scenario():
+            class HangingSession:
+                async def __aenter__(self):
+                    await asyncio.Event().wait()
+
+                async def __aexit__(self, *exc_info):
+                    return False
+
+            batcher = PaymentBatcher(HangingSession, max_wait=0)
+            pending = asyncio.create_task(batcher.submit(PaymentCreate(order_id="ORD1", amount=1)))
+            await asyncio.sleep(0.01)
+            await batcher.stop()
+            return (await asyncio.wait_for(asyncio.gather(pending, return_exceptions=True), 1))[0]
+
+        assert str(asyncio.run(scenario())) == "payment batcher stopped"
+
+
+class TestCompactJsonFormatter:
+    def _record(self, name, msg, level=logging.INFO):
+        return logging.LogRecord(name, level, __file__, 1, msg, None, None)
+
+    def test_header_then_positional_rows_with_interned_loggers(self):
+        formatter = CompactJsonFormatter(stream_id=7)
+        first = self._record("app.main", "service_started")
+        first.created = 1700000000.5
+        first.extra = {"env": "test"}
+        lines = [orjson.loads(line) for line in formatter.format(first).split("\n")]
+        assert lines[0]["stream"] == 7
+        assert lines[0]["schema"] == ["stream", "timestamp", "level", "logger", "message"]
+        assert lines[0]["levels"][1] == "INFO"
+        assert lines[1] == {"stream": 7, "loggers": {"app.main": 0}}
+        assert lines[2] == [7, 1700000000500, 1, 0, "service_started", {"env": "test"}]
+
+        # Known logger: a single row, no header or logger line
+        again = orjson.loads(formatter.format(self._record("app.main", "again", logging.ERROR)))
+        assert again[2:] == [3, 0, "again"]
+
+        new_logger = formatter.format(self._record("uvicorn.error", "hi")).split("\n")
+        assert orjson.loads(new_logger[0]) == {"stream": 7, "loggers": {"uvicorn.error": 1}}
+        assert orjson.loads(new_logger[1])[3] == 1
+
+    def test_stream_defaults_to_pid(self):
+        row = orjson.loads(CompactJsonFormatter().format(self._record("app.main", "hi")).split("\n")[-1])
+        assert row[0] == os.getpid()
+
+    def test_interleaved_worker_streams_decode(self):
+        workers = {101: CompactJsonFormatter(stream_id=101), 202: CompactJsonFormatter(stream_id=202)}
+        # Both workers intern different loggers at index 0 and share one output stream
+        emitted = [
+            (101, "app.main", "a"),
+            (202, "uvicorn.error", "b"),
+            (101, "uvicorn.error", "c"),
+            (202, "app.main", "d"),
+            (101, "app.main", "e"),
+        ]
+        out = "\n".join(workers[pid].format(self._record(name, msg)) for pid, name, msg in emitted)
+
+        loggers: dict[int, dict[int, str]] = {}
+        decoded = []
+        for line in out.split("\n"):
+            item = orjson.loads(line)
+            if isinstance(item, list):
+                decoded.append((item[0], loggers[item[0]][item[3]], item[4]))
+            elif "loggers" in item:
+                loggers.setdefault(item["stream"], {}).update({idx: name for name, idx in item["loggers"].items()})
+        assert decoded == emitted
+
+
+class TestConfigureLogging:
+    def test_records_are_written_by_the_listener_with_exc_info(self, capsys):
+        configure_logging("INFO")
+        try:
+            try:
+                raise ValueError("boom")
+            except ValueError:
+                logging.getLogger("app.test").exception("payment %s failed", "ORD1")
+        finally:
+            # Stopping drains the queue, so the line is on stderr afterwards
+            stop_logging()
+        body = orjson.loads(capsys.readouterr().err)
+        assert body["message"] == "payment ORD1 failed"
+        assert "ValueError: boom" in body["exc_info"]
+
+    def test_records_after_stop_are_written_directly(self, capsys):
+        configure_logging("INFO")
+        stop_logging()
+        logging.getLogger("app.test").error("after_shutdown")
+        body = orjson.loads(capsys.readouterr().err)
+        assert body["message"] == "after_shutdown"
+        assert not any(isinstance(h, QueueHandler) for h in logging.getLogger().handlers)
+
+    def test_access_log_only_enabled_for_debug(self):
+        try:
+            configure_logging("INFO")
+            assert logging.getLogger("uvicorn.access").disabled
+            configure_logging("DEBUG")
+            assert not logging.getLogger("uvicorn.access").disabled
+        finally:
+            stop_logging()
@@ -0,0 +1,34 @@
+import logging.config
+import os
+
+from app import run
+
+
+def test_main_creates_schema_once_before_starting_workers(monkeypatch):
+    calls = []
+
+    async def fake_prepare_database():
+        calls.append("schema")
+
+    def fake_uvicorn_run(app, **kwargs):
+        # Workers are started after the schema exists and are told not to create it again
+        calls.append(("uvicorn", os.environ["DB_CREATE_SCHEMA"], kwargs["workers"]))
+
+    # main() writes os.environ directly; setting it here first makes monkeypatch restore it
+    monkeypatch.setenv("DB_CREATE_SCHEMA", "true")
+    monkeypatch.setenv("WEB_CONCURRENCY", "4")
+    monkeypatch.setattr(run, "_prepare_database", fake_prepare_database)
+    monkeypatch.setattr(run.uvicorn, "run", fake_uvicorn_run)
+    run.main()
+    assert calls == ["schema", ("uvicorn", "false", 4)]
+
+
+def test_log_config_is_valid_dict_config(monkeypatch):
+    uvicorn_logger = logging.getLogger("uvicorn")
+    # dictConfig rewires the global uvicorn logger; put it back for later tests
+    monkeypatch.setattr(uvicorn_logger, "handlers", list(uvicorn_logger.handlers))
+    monkeypatch.setattr(uvicorn_logger, "propagate", uvicorn_logger.propagate)
+    monkeypatch.setattr(uvicorn_logger, "level", uvicorn_logger.level)
+    logging.config.dictConfig(run.log_config("info"))
+    assert uvicorn_logger.handlers
+    assert uvicorn_logger.propagate is False
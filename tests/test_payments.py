@@ -1,12 +1,14 @@
+import asyncio
 import os
 
+import httpx
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.pool import StaticPool
 
-from app.main import Base, app, get_db, get_settings
+from app.main import Base, PaymentBatcher, app, get_db, get_payment_batcher, get_settings
 
 
 @pytest.fixture(autouse=True)
@@ -14,35 +16,44 @@ def set_env(monkeypatch):
     monkeypatch.setenv("API_KEY", "test-key")
     monkeypatch.setenv("ENV", "test")
     # Use in-memory SQLite for tests
-    monkeypatch.setenv("DATABASE_URL", "sqlite+pysqlite:///:memory:")
+    monkeypatch.setenv("DATABASE_URL", "sqlite+aiosqlite:///:memory:")
 
 
 @pytest.fixture()
-def client(monkeypatch):
+def engine():
     # Create new engine per test session to avoid cross-test bleed
-    engine = create_engine(
-        "sqlite+pysqlite:///:memory:",
-        connect_args={"check_same_thread": False},
-        poolclass=StaticPool,
-        future=True,
-    )
-    TestingSessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, expire_on_commit=False, future=True)
-    Base.metadata.create_all(bind=engine)
-
-    def override_get_db():
-        db = TestingSessionLocal()
-        try:
+    return create_async_engine("sqlite+aiosqlite:///:memory:", poolclass=StaticPool)
+
+
+@pytest.fixture()
+def client(monkeypatch, engine):
+    TestingSessionLocal = async_sessionmaker(bind=engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+    async def create_tables():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+
+    async def override_get_db():
+        async with TestingSessionLocal() as db:
             yield db
-        finally:
-            db.close()
+
+    batcher = PaymentBatcher(TestingSessionLocal)
+
+    async def override_get_payment_batcher():
+        return batcher
 
     # Clear cached settings to pick up env overrides
     get_settings.cache_clear()
 
     app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_payment_batcher] = override_get_payment_batcher
 
     with TestClient(app) as c:
+        # Build the schema on the client's event loop so the aiosqlite connection stays on it
+        c.portal.call(create_tables)
         yield c
+        c.portal.call(batcher.stop)
+        c.portal.call(engine.dispose)
 
     app.dependency_overrides.clear()
 
@@ -55,6 +66,7 @@ def test_health(client):
     r = client.get("/health")
     assert r.status_code == 200
     assert r.json()["status"] == "ok"
+    assert r.headers["content-type"] == "application/json"
 
 
 def test_ready(client):
@@ -63,16 +75,28 @@ def test_ready(client):
     assert r.json()["status"] == "ready"
 
 
-# def test_create_payment_happy_path(client):
-#     payload = {"order_id": "ORD123", "amount": 10.5, "currency": "USD"}
-#     r = client.post("/payments", json=payload, headers=auth_headers())
-#     assert r.status_code == 201
-#     body = r.json()
-#     assert body["order_id"] == "ORD123"
-#     assert body["amount"] == 10.5
-#     assert body["currency"] == "USD"
-#     assert "id" in body
-#     assert "created_at" in body
+def test_create_payment_happy_path(client):
+    payload = {"order_id": "ORD123", "amount": 10.5, "currency": "USD"}
+    r = client.post("/payments", json=payload, headers=auth_headers())
+    assert r.status_code == 201
+    body = r.json()
+    assert body["order_id"] == "ORD123"
+    assert body["amount"] == 10.5
+    assert body["currency"] == "USD"
+    assert "id" in body
+    # Timestamps are timezone-aware UTC
+    assert body["created_at"].endswith("+00:00")
+
+
+def test_create_payment_issues_single_insert(client, engine):
+    statements = []
+    event.listen(engine.sync_engine, "before_cursor_execute", lambda conn, cursor, stmt, *args: statements.append(stmt))
+    payload = {"order_id": "ORD124", "amount": 3, "currency": "USD"}
+    r = client.post("/payments", json=payload, headers=auth_headers())
+    assert r.status_code == 201
+    # id and created_at come back from the INSERT itself, no reload SELECT
+    assert [stmt.split()[0] for stmt in statements] == ["INSERT"]
+    assert r.json()["created_at"]
 
 
 def test_create_payment_missing_api_key(client):
@@ -85,3 +109,71 @@ def test_create_payment_invalid_amount(client):
     payload = {"order_id": "ORD123", "amount": -1, "currency": "USD"}
     r = client.post("/payments", json=payload, headers=auth_headers())
     assert r.status_code == 422  # validation error from Pydantic
+
+
+def test_create_payment_rejects_sub_cent_amount(client):
+    payload = {"order_id": "ORD123", "amount": 10.555, "currency": "USD"}
+    r = client.post("/payments", json=payload, headers=auth_headers())
+    assert r.status_code == 422  # more than two decimal places
+
+
+def test_create_payment_rejects_amount_wider_than_column(client):
+    payload = {"order_id": "ORD123", "amount": 12345678901.5, "currency": "USD"}
+    r = client.post("/payments", json=payload, headers=auth_headers())
+    assert r.status_code == 422  # exceeds Numeric(12, 2)
+
+
+def test_create_payment_response_schema_still_documented(client):
+    r = client.get("/openapi.json")
+    created = r.json()["paths"]["/payments"]["post"]["responses"]["201"]
+    assert created["content"]["application/json"]["schema"]["$ref"] == "#/components/schemas/PaymentRead"
+
+
+def test_openapi_served_from_startup_render(client):
+    r = client.get("/openapi.json")
+    assert r.status_code == 200
+    assert r.content == app.state.openapi_bytes[""]
+    assert client.get("/docs").status_code == 200
+
+
+def test_concurrent_payments_share_one_commit(client, engine):
+    # A wide window so all five requests land in one batch even on a slow runner
+    batcher = PaymentBatcher(async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False), max_wait=1)
+
+    async def override_get_payment_batcher():
+        return batcher
+
+    app.dependency_overrides[get_payment_batcher] = override_get_payment_batcher
+    commits = []
+    event.listen(engine.sync_engine, "commit", lambda conn: commits.append(conn))
+
+    async def post_many():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://testserver") as ac:
+            payloads = [{"order_id": f"ORD{i}", "amount": i + 1, "currency": "USD"} for i in range(5)]
+            return await asyncio.gather(*(ac.post("/payments", json=p, headers=auth_headers()) for p in payloads))
+
+    try:
+        responses = client.portal.call(post_many)
+    finally:
+        client.portal.call(batcher.stop)
+    assert [r.status_code for r in responses] == [201] * 5
+    # Each caller gets its own row back, in submission order
+    assert [r.json()["order_id"] for r in responses] == [f"ORD{i}" for i in range(5)]
+    assert len({r.json()["id"] for r in responses}) == 5
+    assert len(commits) == 1
+
+
+def test_openapi_lists_root_path_as_server(client):
+    behind_proxy = TestClient(app, root_path="/api")
+    body = behind_proxy.get("/openapi.json").json()
+    assert body["servers"][0] == {"url": "/api"}
+    # The plain render is untouched
+    assert "servers" not in client.get("/openapi.json").json()
+
+
+def test_openapi_renders_without_lifespan(monkeypatch):
+    # Not entered as a context manager, so the lifespan warm-up never runs
+    monkeypatch.delattr(app.state, "openapi_bytes", raising=False)
+    r = TestClient(app).get("/openapi.json")
+    assert r.status_code == 200
+    assert r.json()["paths"]["/payments"]